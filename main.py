@@ -1,17 +1,29 @@
+import asyncio
+import atexit
 import logging
 import os
-from typing import Any, Dict, List
+import pathlib
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, List, Optional, Set
+from urllib.parse import quote
 
+import anyio.to_thread
+import httpx
+import uvicorn
 from dotenv import load_dotenv
-from fastapi import FastAPI, File, Form, HTTPException, Path, UploadFile, WebSocket, WebSocketDisconnect
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, File, Form, HTTPException, Path, UploadFile, WebSocket
+from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel, Field
+from pydantic import Field
+from starlette.background import BackgroundTask
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 from services.stt_service import STTService
 from services.llm_service import LLMService
-from services.tts_service import TTSService
+from services.tts_service import TTSService, collect_sentences
+from services.history_service import HistoryService
 
 # --- Load environment variables ---
 load_dotenv()
@@ -22,12 +34,29 @@ class Settings(BaseSettings):
     assemblyai_api_key: str = Field(..., alias="ASSEMBLYAI_API_KEY")
     gemini_api_key: str = Field(..., alias="GEMINI_API_KEY")
     murf_api_url: str = "https://api.murf.ai/v1/speech/generate"
+    gemini_model: str = "gemini-1.5-flash"
+    redis_url: Optional[str] = Field(None, alias="REDIS_URL")
+    thread_pool_limit: int = 200
+    # Spoken while Gemini works on the reply; set to "" to disable.
+    filler_text: str = "Let me think."
+    # Spoken when the reply fails after audio has already started streaming.
+    apology_text: str = "Sorry, something went wrong while answering. Please try again."
     model_config = SettingsConfigDict(env_file=".env", extra="ignore")
 
 settings = Settings()
 
 # --- Logging ---
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+# Records are only enqueued on the event loop; a background thread does the
+# formatting and the blocking writes to stderr.
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+log_queue: queue.Queue = queue.Queue(-1)
+log_listener = QueueListener(log_queue, log_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+# Only the message is rendered on the event loop; the listener's handler
+# adds the timestamped format.
+logging.basicConfig(level=logging.INFO, format="%(message)s", handlers=[QueueHandler(log_queue)], force=True)
 logger = logging.getLogger(__name__)
 
 # --- Service Initialization ---
@@ -38,7 +67,7 @@ except Exception as e:
     stt_service = None
 
 try:
-    llm_service = LLMService(settings.gemini_api_key)
+    llm_service = LLMService(settings.gemini_api_key, settings.gemini_model)
 except Exception as e:
     logger.error(e)
     llm_service = None
@@ -49,34 +78,82 @@ except Exception as e:
     logger.error(e)
     tts_service = None
 
-# --- In-memory chat store ---
-chat_histories: Dict[str, List[Dict[str, Any]]] = {}
+try:
+    history_service = HistoryService(settings.redis_url)
+except Exception as e:
+    logger.error(e)
+    history_service = None
+
+# --- Lifespan ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Blocking SDK calls share AnyIO's default thread pool (40 threads).
+    anyio.to_thread.current_default_thread_limiter().total_tokens = settings.thread_pool_limit
+    # One keep-alive HTTP/2 pool per app run, shared by all outbound API calls.
+    http_client = httpx.AsyncClient(
+        http2=True,
+        timeout=90.0,
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=50)
+    )
+    for service in (stt_service, tts_service):
+        if service:
+            service.client = http_client
+    yield
+    await http_client.aclose()
+    if history_service:
+        await history_service.close()
 
 # --- FastAPI App ---
 app = FastAPI(
     title="AI Voice Agent Backend",
     description="Refactored backend for Day 14 + Day 15 WebSocket",
-    version="3.1.0"
+    version="3.1.0",
+    lifespan=lifespan
 )
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
-# --- Pydantic Response Model ---
-class ChatResponse(BaseModel):
-    audio_url: str
-    user_text: str
-    ai_text: str
+# --- Frontend entry point, resolved once instead of on every request ---
+INDEX_PATH = pathlib.Path("static", "index.html").resolve()
+INDEX_AVAILABLE = INDEX_PATH.is_file()
+if not INDEX_AVAILABLE:
+    logger.error("index.html not found in static directory.")
+
+# --- Streaming helpers ---
+UPLOAD_CHUNK_SIZE = 65536
+
+async def iterate_upload(file: UploadFile) -> AsyncIterator[bytes]:
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        yield chunk
+
+async def iterate_queue(queue: asyncio.Queue) -> AsyncIterator[Any]:
+    # Yield queued items until a None sentinel marks the end of the stream.
+    while (item := await queue.get()) is not None:
+        yield item
+
+async def iterate_text(text: str) -> AsyncIterator[str]:
+    yield text
+
+async def prime_stream(stream: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    # Pull the first chunk up front so upstream failures still surface as an
+    # HTTP error instead of a truncated 200 response.
+    first_chunk = await stream.__anext__()
+
+    async def replay() -> AsyncIterator[bytes]:
+        yield first_chunk
+        async for chunk in stream:
+            yield chunk
+
+    return replay()
 
 # --- Routes ---
 @app.get("/")
 async def serve_index():
-    index_path = os.path.join("static", "index.html")
-    if not os.path.exists(index_path):
-        logger.error("index.html not found in static directory.")
+    if not INDEX_AVAILABLE:
         raise HTTPException(status_code=404, detail="Frontend not found.")
-    return FileResponse(index_path)
+    return FileResponse(INDEX_PATH)
 
-@app.post("/agent/chat/{session_id}", response_model=ChatResponse)
+@app.post("/agent/chat/{session_id}", response_class=StreamingResponse)
 async def conversational_chat(
     session_id: str = Path(..., description="The unique conversation ID."),
     file: UploadFile = File(...),
@@ -84,44 +161,172 @@ async def conversational_chat(
 ):
     logger.info(f"Processing chat for session {session_id} with voice {voice_id}")
 
-    if not stt_service or not llm_service or not tts_service:
+    if not stt_service or not llm_service or not tts_service or not history_service:
         raise HTTPException(status_code=503, detail="One or more services are unavailable.")
 
-    # Step 1: Speech-to-Text
+    # Three overlapped stages linked by queues: Speech-to-Text resolves the
+    # transcript, the LLM stage pushes finished sentences as tokens arrive,
+    # and the TTS stage turns each sentence into audio for the response.
     try:
-        audio_bytes = await file.read()
-        user_text = stt_service.transcribe_audio(audio_bytes)
+        history = await history_service.load(session_id)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    transcript: asyncio.Future = asyncio.get_running_loop().create_future()
+    sentence_q: asyncio.Queue = asyncio.Queue()
+    audio_q: asyncio.Queue = asyncio.Queue()
+    # Set by the LLM stage once the whole reply has been queued; the turn is
+    # only stored after the speech stage has actually played it.
+    completed_turns: Optional[tuple] = None
+    speech_failed = asyncio.Event()
 
-    # Step 2: LLM Response
-    try:
-        history = chat_histories.get(session_id, [])
-        history.append({"role": "user", "parts": [user_text]})
-        ai_text = llm_service.generate_reply(history)
-        history.append({"role": "model", "parts": [ai_text]})
-        chat_histories[session_id] = history
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    # Stage A: Speech-to-Text
+    async def transcribe_stage() -> None:
+        try:
+            transcript.set_result(await stt_service.transcribe_stream(iterate_upload(file)))
+        except Exception as e:
+            transcript.set_exception(e)
+            raise
+        finally:
+            transcript.cancel()
+
+    # Stage B: LLM tokens -> sentences
+    async def reply_stage() -> None:
+        try:
+            user_text = await transcript
+            user_turn = {"role": "user", "parts": [user_text]}
+            spoken = False
+            if settings.filler_text:
+                # Queued ahead of the reply so the filler is synthesized while
+                # the LLM is still producing its first sentence.
+                await sentence_q.put(settings.filler_text)
+                spoken = True
+            reply_parts: List[str] = []
+
+            async def reply_tokens() -> AsyncIterator[str]:
+                async for token in llm_service.stream_reply(session_id, history, user_text):
+                    reply_parts.append(token)
+                    yield token
+
+            try:
+                async for sentence in collect_sentences(reply_tokens()):
+                    if speech_failed.is_set():
+                        # The listener already got an apology; stop generating.
+                        return
+                    await sentence_q.put(sentence)
+                    spoken = True
+            except Exception as e:
+                if not spoken:
+                    raise
+                # Audio has already started, so an HTTP error is no longer
+                # possible; apologise and end the stream cleanly instead.
+                logger.error(f"Reply failed mid-stream for session {session_id}: {e}")
+                await sentence_q.put(settings.apology_text)
+                return
+            ai_text = "".join(reply_parts).strip()
+            nonlocal completed_turns
+            completed_turns = (user_turn, {"role": "model", "parts": [ai_text]})
+        finally:
+            sentence_q.put_nowait(None)
+
+    # Stage C: sentences -> audio
+    async def speech_stage() -> None:
+        played = False
+        try:
+            try:
+                async for chunk in tts_service.stream(iterate_queue(sentence_q), voice_id):
+                    await audio_q.put(chunk)
+                    played = True
+            except Exception as e:
+                if not played:
+                    raise
+                # Same as a mid-stream LLM failure: the 200 is already out, so
+                # apologise and end the stream cleanly without storing the turn.
+                logger.error(f"Speech failed mid-stream for session {session_id}: {e}")
+                speech_failed.set()
+                try:
+                    async for chunk in tts_service.stream(iterate_text(settings.apology_text), voice_id):
+                        await audio_q.put(chunk)
+                except Exception as e:
+                    logger.error(f"Apology synthesis failed for session {session_id}: {e}")
+                return
+            if completed_turns is not None:
+                await history_service.append(session_id, *completed_turns)
+        finally:
+            audio_q.put_nowait(None)
+
+    stages = asyncio.gather(transcribe_stage(), reply_stage(), speech_stage())
+
+    async def audio_chunks() -> AsyncIterator[bytes]:
+        try:
+            async for chunk in iterate_queue(audio_q):
+                yield chunk
+            await stages
+        finally:
+            stages.cancel()
+
+    async def maintain_session() -> None:
+        try:
+            stored = await history_service.load(session_id)
+            if not stored:
+                return
+            folded, compacted = await llm_service.compact_history(stored)
+            if folded and not await history_service.fold_prefix(session_id, folded, stored[folded], compacted[0]):
+                return
+            await llm_service.refresh_context_cache(session_id, compacted)
+        except Exception as e:
+            logger.error(f"Could not maintain history for session {session_id}: {e}")
 
-    # Step 3: Text-to-Speech
     try:
-        audio_url = await tts_service.synthesize(ai_text, voice_id)
+        audio_stream = await prime_stream(audio_chunks())
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-    return ChatResponse(audio_url=audio_url, user_text=user_text, ai_text=ai_text)
+    # History upkeep (summaries, context cache) runs after the audio is sent.
+    return StreamingResponse(
+        audio_stream,
+        media_type="audio/mpeg",
+        headers={"X-User-Text": quote(transcript.result())},
+        background=BackgroundTask(maintain_session),
+    )
 
 # --- WebSocket Echo Endpoint (Day 15) ---
+connections: Set[WebSocket] = set()
+
+async def broadcast(text: str) -> None:
+    # Sends run concurrently; a failing peer is logged and dropped instead of
+    # stopping delivery to the others.
+    peers = list(connections)
+    results = await asyncio.gather(*(ws.send_text(text) for ws in peers), return_exceptions=True)
+    for ws, result in zip(peers, results):
+        if isinstance(result, Exception):
+            logger.warning(f"WebSocket: dropping client after failed send: {result!r}")
+            connections.discard(ws)
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
+    connections.add(websocket)
     logger.info("WebSocket: client connected")
-    await websocket.send_text("👋 Connected to WebSocket echo server. Send me something!")
     try:
-        while True:
-            data = await websocket.receive_text()
+        await websocket.send_text("👋 Connected to WebSocket echo server. Send me something!")
+        async for data in websocket.iter_text():
             logger.info(f"WebSocket received: {data}")
-            await websocket.send_text(f"Echo: {data}")
-    except WebSocketDisconnect:
-        logger.info("WebSocket: client disconnected")
+            await broadcast(f"Echo: {data}")
+    finally:
+        connections.discard(websocket)
+    logger.info("WebSocket: client disconnected")
+
+# --- Production entrypoint: `python main.py` ---
+if __name__ == "__main__":
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        # "auto" picks uvloop where it is installed (it is not on Windows).
+        loop="auto",
+        http="httptools",
+        ws="websockets",
+        # Without Redis each worker would keep its own chat histories.
+        workers=os.cpu_count() if settings.redis_url else 1,
+        access_log=False
+    )
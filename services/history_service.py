@@ -0,0 +1,98 @@
+import json
+import logging
+from typing import Any, Dict, List, Optional
+
+import redis.asyncio as redis
+from cachetools import TTLCache
+
+logger = logging.getLogger(__name__)
+
+class HistoryService:
+    def __init__(self, redis_url: Optional[str] = None, ttl_seconds: int = 1800, max_local_sessions: int = 10_000):
+        # Without a Redis URL, histories live in this process only, which is
+        # fine for a single worker but not shared across `--workers N`. Either
+        # way a session idle for ttl_seconds is dropped.
+        self.redis = redis.Redis.from_url(redis_url, decode_responses=True) if redis_url else None
+        self.ttl_seconds = ttl_seconds
+        self._local: "TTLCache[str, List[Dict[str, Any]]]" = TTLCache(maxsize=max_local_sessions, ttl=ttl_seconds)
+        if self.redis:
+            logger.info("Redis chat history store initialized successfully.")
+        else:
+            logger.info("REDIS_URL not set; using in-process chat history store.")
+
+    @staticmethod
+    def _key(session_id: str) -> str:
+        return f"hist:{session_id}"
+
+    async def load(self, session_id: str) -> List[Dict[str, Any]]:
+        if not self.redis:
+            history = self._local.get(session_id)
+            if history is None:
+                return []
+            # Re-setting the entry restarts its idle timer.
+            self._local[session_id] = history
+            return list(history)
+        try:
+            return [json.loads(turn) for turn in await self.redis.lrange(self._key(session_id), 0, -1)]
+        except Exception as e:
+            logger.error(f"Loading history for session {session_id} failed: {e}")
+            raise
+
+    async def append(self, session_id: str, *turns: Dict[str, Any]) -> None:
+        if not self.redis:
+            self._local[session_id] = [*self._local.get(session_id, []), *turns]
+            return
+        try:
+            key = self._key(session_id)
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.rpush(key, *(json.dumps(turn) for turn in turns))
+                pipe.expire(key, self.ttl_seconds)
+                await pipe.execute()
+        except Exception as e:
+            logger.error(f"Saving history for session {session_id} failed: {e}")
+            raise
+
+    async def fold_prefix(
+        self,
+        session_id: str,
+        folded: int,
+        first_kept: Dict[str, Any],
+        summarized_first: Dict[str, Any],
+    ) -> bool:
+        # Replaces the first `folded` turns plus `first_kept` with the single
+        # `summarized_first` turn. Only that prefix is rewritten, so turns
+        # appended while the summary was being generated survive. Returns
+        # False if the prefix changed in the meantime (e.g. another worker
+        # already compacted the session).
+        if not self.redis:
+            current = self._local.get(session_id)
+            if current is None or len(current) <= folded or current[folded] != first_kept:
+                return False
+            self._local[session_id] = [summarized_first, *current[folded + 1:]]
+            return True
+        try:
+            key = self._key(session_id)
+            async with self.redis.pipeline(transaction=True) as pipe:
+                while True:
+                    try:
+                        await pipe.watch(key)
+                        current = await pipe.lindex(key, folded)
+                        if current is None or json.loads(current) != first_kept:
+                            await pipe.unwatch()
+                            return False
+                        pipe.multi()
+                        pipe.ltrim(key, folded, -1)
+                        pipe.lset(key, 0, json.dumps(summarized_first))
+                        pipe.expire(key, self.ttl_seconds)
+                        await pipe.execute()
+                        return True
+                    except redis.WatchError:
+                        # A turn was appended between WATCH and EXEC; retry.
+                        continue
+        except Exception as e:
+            logger.error(f"Compacting history for session {session_id} failed: {e}")
+            raise
+
+    async def close(self) -> None:
+        if self.redis:
+            await self.redis.aclose()
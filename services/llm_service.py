@@ -1,23 +1,171 @@
+import datetime
+import functools
 import logging
+import math
+import re
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, Tuple
+
+import anyio.to_thread
 import google.generativeai as genai
+from google.generativeai import ChatSession, caching
 
 logger = logging.getLogger(__name__)
 
 class LLMService:
+    # Once a history grows past either limit, everything but the most recent
+    # turns is folded into a summary so prompt size stays bounded.
+    max_history_turns = 20
+    max_history_tokens = 4000
+    keep_recent_turns = 10
+    # Gemini only caches prompts above a minimum size, and only for versioned
+    # model names (e.g. gemini-1.5-flash-002); other histories are sent in
+    # full every turn.
+    context_cache_min_tokens = 32768
+    context_cache_ttl = datetime.timedelta(minutes=10)
+    max_chat_sessions = 1024
+
     def __init__(self, api_key: str, model_name: str = "gemini-1.5-flash"):
         if not api_key or "your_new_gemini_api_key" in api_key:
             raise ValueError("GEMINI_API_KEY is not set correctly.")
         genai.configure(api_key=api_key)
         self.model = genai.GenerativeModel(model_name)
+        self.context_caching = re.search(r"-\d{3}$", model_name) is not None
+        if not self.context_caching:
+            logger.info(f"Context caching disabled: {model_name} is not a versioned model name.")
+        # LRU of session_id -> (cached turns, cache handle, model bound to it, expiry)
+        self._cached_prefix: "OrderedDict[str, Tuple[list, caching.CachedContent, genai.GenerativeModel, float]]" = OrderedDict()
+        # LRU of session_id -> (chat, stored history it mirrors, expiry); the
+        # chat keeps the history already converted to protos, so only the new
+        # message is marshalled each turn.
+        self._sessions: "OrderedDict[str, Tuple[ChatSession, list, float]]" = OrderedDict()
         logger.info("Google Gemini initialized successfully.")
 
-    def generate_reply(self, history: list) -> str:
+    def _model_for(self, session_id: str, history: list) -> Tuple[genai.GenerativeModel, list, float]:
+        entry = self._cached_prefix.get(session_id)
+        if entry:
+            turns, _, cached_model, expires_at = entry
+            if time.monotonic() < expires_at and history[:len(turns)] == turns:
+                self._cached_prefix.move_to_end(session_id)
+                return cached_model, history[len(turns):], expires_at
+        return self.model, history, math.inf
+
+    def _checkout_chat(self, session_id: str, history: list) -> Tuple[ChatSession, float]:
+        # The stored history is the source of truth (other workers may have
+        # added turns or compacted it), so a pooled chat is only reused while
+        # it still mirrors that history exactly. Checked-out chats leave the
+        # pool so concurrent turns of one session never share a ChatSession.
+        entry = self._sessions.pop(session_id, None)
+        if entry:
+            chat, mirrored, expires_at = entry
+            if time.monotonic() < expires_at and mirrored == history:
+                return chat, expires_at
+
+        model, contents, expires_at = self._model_for(session_id, history)
+        return model.start_chat(history=contents), expires_at
+
+    def _checkin_chat(self, session_id: str, chat: ChatSession, mirrored: list, expires_at: float) -> None:
+        self._sessions[session_id] = (chat, mirrored, expires_at)
+        if len(self._sessions) > self.max_chat_sessions:
+            self._sessions.popitem(last=False)
+
+    async def stream_reply(self, session_id: str, history: list, user_text: str) -> AsyncIterator[str]:
         try:
-            llm_response = self.model.generate_content(history)
-            text = llm_response.text.strip() if llm_response.text else ""
-            if not text:
+            chat, expires_at = self._checkout_chat(session_id, history)
+            response = await chat.send_message_async(user_text, stream=True)
+            reply_parts = []
+            async for chunk in response:
+                if chunk.text:
+                    reply_parts.append(chunk.text)
+                    yield chunk.text
+            reply = "".join(reply_parts).strip()
+            if not reply:
                 raise ValueError("LLM returned an empty response.")
-            return text
         except Exception as e:
-            logger.error(f"LLM generation failed: {e}")
+            logger.error(f"LLM streaming failed: {e}")
+            raise
+
+        # Only a chat whose stream completed can take the next message.
+        mirrored = history + [{"role": "user", "parts": [user_text]}, {"role": "model", "parts": [reply]}]
+        self._checkin_chat(session_id, chat, mirrored, expires_at)
+
+    async def compact_history(self, history: list) -> Tuple[int, list]:
+        # Returns how many leading turns were folded into the summary (0 when
+        # nothing changed) along with the compacted history.
+        if len(history) <= self.keep_recent_turns:
+            return 0, history
+        if len(history) <= self.max_history_turns:
+            token_count = (await self.model.count_tokens_async(history)).total_tokens
+            if token_count <= self.max_history_tokens:
+                return 0, history
+
+        older, recent = history[:-self.keep_recent_turns], history[-self.keep_recent_turns:]
+        transcript = "\n".join(
+            f"{turn['role']}: {' '.join(str(part) for part in turn['parts'])}" for turn in older
+        )
+        try:
+            response = await self.model.generate_content_async(
+                "Summarize this conversation in a few sentences, keeping any facts "
+                "the user shared:\n" + transcript
+            )
+            summary = response.text.strip()
+        except Exception as e:
+            logger.error(f"History summarization failed: {e}")
+            raise
+
+        # Fold the summary into the first kept turn so roles keep alternating.
+        first = recent[0]
+        summary_part = f"<conversation-summary>{summary}</conversation-summary>"
+        return len(older), [{"role": first["role"], "parts": [summary_part, *first["parts"]]}, *recent[1:]]
+
+    async def _drop_context_cache(self, cached: caching.CachedContent) -> None:
+        try:
+            await anyio.to_thread.run_sync(cached.delete)
+        except Exception as e:
+            logger.warning(f"Could not delete context cache {cached.name}: {e}")
+
+    async def refresh_context_cache(self, session_id: str, history: list) -> None:
+        if not self.context_caching:
+            return
+        entry = self._cached_prefix.get(session_id)
+        if entry:
+            turns, cached, _, expires_at = entry
+            if (
+                time.monotonic() < expires_at
+                and history[:len(turns)] == turns
+                and len(history) - len(turns) < self.keep_recent_turns
+            ):
+                return
+            del self._cached_prefix[session_id]
+            self._sessions.pop(session_id, None)
+            await self._drop_context_cache(cached)
+
+        # A token is at least one character, so shorter histories cannot reach
+        # the minimum; this avoids a count_tokens call on almost every turn.
+        characters = sum(len(str(part)) for turn in history for part in turn["parts"])
+        if characters < self.context_cache_min_tokens:
+            return
+        if (await self.model.count_tokens_async(history)).total_tokens < self.context_cache_min_tokens:
+            return
+        try:
+            cached = await anyio.to_thread.run_sync(
+                functools.partial(
+                    caching.CachedContent.create,
+                    model=self.model.model_name,
+                    contents=history,
+                    ttl=self.context_cache_ttl,
+                )
+            )
+        except Exception as e:
+            logger.error(f"Context cache creation failed: {e}")
             raise
+        # Stop using the handle a little before the server drops it.
+        expires_at = time.monotonic() + self.context_cache_ttl.total_seconds() - 30
+        self._cached_prefix[session_id] = (
+            list(history), cached, genai.GenerativeModel.from_cached_content(cached), expires_at
+        )
+        self._sessions.pop(session_id, None)
+        if len(self._cached_prefix) > self.max_chat_sessions:
+            _, (_, evicted, _, _) = self._cached_prefix.popitem(last=False)
+            await self._drop_context_cache(evicted)
@@ -1,19 +1,44 @@
 import logging
+from typing import AsyncIterator, Optional
+
+import anyio.to_thread
 import assemblyai as aai
+import httpx
 
 logger = logging.getLogger(__name__)
 
 class STTService:
-    def __init__(self, api_key: str):
+    def __init__(
+        self,
+        api_key: str,
+        upload_url: str = "https://api.assemblyai.com/v2/upload",
+        client: Optional[httpx.AsyncClient] = None,
+    ):
         if not api_key or "your_assemblyai_api_key" in api_key:
             raise ValueError("ASSEMBLYAI_API_KEY is not set correctly.")
         aai.settings.api_key = api_key
         self.transcriber = aai.Transcriber()
+        self.api_key = api_key
+        self.upload_url = upload_url
+        # Injected by the app lifespan, which owns the shared connection pool.
+        self.client = client
         logger.info("AssemblyAI initialized successfully.")
 
-    def transcribe_audio(self, audio_bytes: bytes) -> str:
+    async def upload(self, chunks: AsyncIterator[bytes]) -> str:
+        # FastAPI has already spooled the multipart body by the time the route
+        # runs; forwarding it in chunks just avoids one whole-file bytes copy.
+        response = await self.client.post(
+            self.upload_url, headers={"authorization": self.api_key}, content=chunks
+        )
+        response.raise_for_status()
+        return response.json()["upload_url"]
+
+    async def transcribe_stream(self, chunks: AsyncIterator[bytes]) -> str:
         try:
-            transcript = self.transcriber.transcribe(audio_bytes)
+            audio_url = await self.upload(chunks)
+            # The SDK call blocks while it polls, so it runs on the AnyIO
+            # thread pool whose size is set in the app lifespan.
+            transcript = await anyio.to_thread.run_sync(self.transcriber.transcribe, audio_url)
             if transcript.error:
                 raise ValueError(transcript.error)
             text = transcript.text.strip()
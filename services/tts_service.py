@@ -1,33 +1,154 @@
+import asyncio
+import hashlib
 import logging
+import re
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, List, Optional, Tuple
+
 import httpx
+import orjson
 
 logger = logging.getLogger(__name__)
 
+_SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+")
+_MIN_SENTENCE_LENGTH = 30
+_CHUNK_SIZE = 65536
+_MAX_TEXT_LENGTH = 2999
+
+
+def fit_text_limit(text: str) -> str:
+    # Murf rejects long texts. Short texts are passed through untouched;
+    # longer ones are cut at the last sentence (or word) boundary that fits.
+    if len(text) <= _MAX_TEXT_LENGTH:
+        return text
+    cut = text.rfind(". ", 0, _MAX_TEXT_LENGTH)
+    if cut > 0:
+        return text[:cut + 1]
+    cut = text.rfind(" ", 0, _MAX_TEXT_LENGTH)
+    return text[:cut] if cut > 0 else text[:_MAX_TEXT_LENGTH]
+
+
+async def collect_sentences(tokens: AsyncIterator[str]) -> AsyncIterator[str]:
+    # Pieces shorter than _MIN_SENTENCE_LENGTH (abbreviations like "Mr." or
+    # "e.g.", list markers like "1.") are merged into the following text so
+    # each Murf call gets a natural-sounding span instead of a fragment.
+    buffer = ""
+    pending = ""
+    async for token in tokens:
+        buffer += token
+        *complete, buffer = _SENTENCE_BOUNDARY.split(buffer)
+        for sentence in complete:
+            if sentence.strip():
+                pending = f"{pending} {sentence.strip()}".lstrip()
+                if len(pending) >= _MIN_SENTENCE_LENGTH:
+                    yield pending
+                    pending = ""
+    rest = f"{pending} {buffer.strip()}".strip()
+    if rest:
+        yield rest
+
+
 class TTSService:
-    def __init__(self, api_key: str, api_url: str):
+    def __init__(
+        self,
+        api_key: str,
+        api_url: str,
+        client: Optional[httpx.AsyncClient] = None,
+        cache_size: int = 1024,
+        cache_ttl_seconds: Optional[float] = 3600.0,
+    ):
         if not api_key or "your_murf_api_key" in api_key:
             raise ValueError("MURF_API_KEY is not set correctly.")
         self.api_key = api_key
         self.api_url = api_url
+        self._headers = {
+            "accept": "application/json",
+            "Content-Type": "application/json",
+            "api-key": api_key
+        }
+        # Injected by the app lifespan, which owns the shared connection pool.
+        self.client = client
+        # LRU of (text digest, voice_id) -> (audio URL, cached at). Murf audio
+        # URLs expire, so entries also carry an absolute TTL.
+        self._cache: "OrderedDict[Tuple[bytes, str], Tuple[str, float]]" = OrderedDict()
+        self.cache_size = cache_size
+        self.cache_ttl_seconds = cache_ttl_seconds
+
+    def _cache_get(self, key: Tuple[bytes, str]) -> Optional[str]:
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        audio_url, cached_at = entry
+        if self.cache_ttl_seconds is not None and time.monotonic() - cached_at > self.cache_ttl_seconds:
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return audio_url
+
+    def _cache_put(self, key: Tuple[bytes, str], audio_url: str) -> None:
+        self._cache[key] = (audio_url, time.monotonic())
+        self._cache.move_to_end(key)
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
 
     async def synthesize(self, text: str, voice_id: str) -> str:
+        text = fit_text_limit(text)
+        key = (hashlib.blake2b(text.encode(), digest_size=16).digest(), voice_id)
+        cached_url = self._cache_get(key)
+        if cached_url is not None:
+            return cached_url
+
         try:
-            headers = {
-                "accept": "application/json",
-                "Content-Type": "application/json",
-                "api-key": self.api_key
-            }
-            payload = {"text": text[:2999], "voice_id": voice_id}
-
-            async with httpx.AsyncClient(timeout=90.0) as client:
-                response = await client.post(self.api_url, headers=headers, json=payload)
-                response.raise_for_status()
+            payload = orjson.dumps({"text": text, "voice_id": voice_id, "format": "MP3"})
+            response = await self.client.post(self.api_url, headers=self._headers, content=payload)
+            response.raise_for_status()
 
             data = response.json()
             audio_url = data.get("audio_url") or data.get("audioFile")
             if not audio_url:
                 raise ValueError("TTS API did not return an audio URL.")
+            self._cache_put(key, audio_url)
             return audio_url
         except Exception as e:
             logger.error(f"TTS generation failed: {e}")
             raise
+
+    async def stream(self, sentences: AsyncIterator[str], voice_id: str) -> AsyncIterator[bytes]:
+        # Each sentence is synthesized as soon as it arrives but audio is
+        # yielded in order, so sentence N+1 is generated while N is played.
+        pending: asyncio.Queue = asyncio.Queue()
+        tasks: List[asyncio.Task] = []
+
+        async def schedule() -> None:
+            try:
+                async for sentence in sentences:
+                    queue: asyncio.Queue = asyncio.Queue()
+                    task = asyncio.create_task(self._fetch_audio(sentence, voice_id, queue))
+                    tasks.append(task)
+                    await pending.put((task, queue))
+            finally:
+                pending.put_nowait(None)
+
+        scheduler = asyncio.create_task(schedule())
+        try:
+            while (item := await pending.get()) is not None:
+                task, queue = item
+                while (chunk := await queue.get()) is not None:
+                    yield chunk
+                await task
+            await scheduler
+        finally:
+            scheduler.cancel()
+            for task in tasks:
+                task.cancel()
+
+    async def _fetch_audio(self, text: str, voice_id: str, queue: asyncio.Queue) -> None:
+        try:
+            audio_url = await self.synthesize(text, voice_id)
+            async with self.client.stream("GET", audio_url) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_bytes(_CHUNK_SIZE):
+                    await queue.put(chunk)
+        finally:
+            queue.put_nowait(None)